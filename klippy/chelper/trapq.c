@@ -163,6 +163,29 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Add a single axis move (starting and ending at rest) to the queue
+double __visible
+trapq_manual_move(struct trapq *tq, double print_time, double start_pos
+                  , double dist, double speed, double accel)
+{
+    double axis_r = 1.;
+    if (dist < 0.) {
+        axis_r = -1.;
+        dist = -dist;
+    }
+    double accel_t = 0., cruise_t = dist / speed;
+    if (accel && dist) {
+        double max_cruise_v2 = dist * accel;
+        if (max_cruise_v2 < speed * speed)
+            speed = sqrt(max_cruise_v2);
+        accel_t = speed / accel;
+        cruise_t = (dist - accel_t * speed) / speed;
+    }
+    trapq_append(tq, print_time, accel_t, cruise_t, accel_t
+                 , start_pos, 0., 0., axis_r, 0., 0., 0., speed, accel);
+    return accel_t + cruise_t + accel_t;
+}
+
 #define HISTORY_EXPIRE (30.0)
 
 // Expire any moves older than `print_time` from the trapezoid velocity queue
@@ -43,6 +43,9 @@ void trapq_append(struct trapq *tq, double print_time
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+double trapq_manual_move(struct trapq *tq, double print_time
+                         , double start_pos, double dist, double speed
+                         , double accel);
 void trapq_finalize_moves(struct trapq *tq, double print_time);
 void trapq_set_position(struct trapq *tq, double print_time
                         , double pos_x, double pos_y, double pos_z);
@@ -4,7 +4,6 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import stepper, chelper
-from . import force_move
 
 class ManualStepper:
     def __init__(self, config):
@@ -18,13 +17,19 @@ class ManualStepper:
             self.can_home = False
             self.rail = stepper.PrinterStepper(config)
             self.steppers = [self.rail]
+        self.rail_name = self.rail.get_name()
         self.velocity = config.getfloat('velocity', 5., above=0.)
         self.accel = self.homing_accel = config.getfloat('accel', 0., minval=0.)
         self.next_cmd_time = 0.
+        self.setpos_coord = [0., 0., 0.]
+        self.toolhead = None
+        self.enables = []
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_manual_move = ffi_lib.trapq_manual_move
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.rail.setup_itersolve('cartesian_stepper_alloc', b'x')
         self.rail.set_trapq(self.trapq)
@@ -34,8 +39,13 @@ class ManualStepper:
         gcode.register_mux_command('MANUAL_STEPPER', "STEPPER",
                                    stepper_name, self.cmd_MANUAL_STEPPER,
                                    desc=self.cmd_MANUAL_STEPPER_help)
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        stepper_enable = self.printer.lookup_object('stepper_enable')
+        self.enables = [stepper_enable.lookup_enable(s.get_name())
+                        for s in self.steppers]
     def sync_print_time(self):
-        toolhead = self.printer.lookup_object('toolhead')
+        toolhead = self.toolhead
         print_time = toolhead.get_last_move_time()
         if self.next_cmd_time > print_time:
             toolhead.dwell(self.next_cmd_time - print_time)
@@ -43,33 +53,27 @@ class ManualStepper:
             self.next_cmd_time = print_time
     def do_enable(self, enable):
         self.sync_print_time()
-        stepper_enable = self.printer.lookup_object('stepper_enable')
         if enable:
-            for s in self.steppers:
-                se = stepper_enable.lookup_enable(s.get_name())
+            for se in self.enables:
                 se.motor_enable(self.next_cmd_time)
         else:
-            for s in self.steppers:
-                se = stepper_enable.lookup_enable(s.get_name())
+            for se in self.enables:
                 se.motor_disable(self.next_cmd_time)
-        self.sync_print_time()
     def do_set_position(self, setpos):
-        self.rail.set_position([setpos, 0., 0.])
+        self.setpos_coord[0] = setpos
+        self.rail.set_position(self.setpos_coord)
     def do_move(self, movepos, speed, accel, sync=True):
         self.sync_print_time()
         cp = self.rail.get_commanded_position()
         dist = movepos - cp
-        axis_r, accel_t, cruise_t, cruise_v = force_move.calc_move_time(
-            dist, speed, accel)
-        self.trapq_append(self.trapq, self.next_cmd_time,
-                          accel_t, cruise_t, accel_t,
-                          cp, 0., 0., axis_r, 0., 0.,
-                          0., cruise_v, accel)
-        self.next_cmd_time = self.next_cmd_time + accel_t + cruise_t + accel_t
+        if not dist:
+            # Already at the requested position
+            return
+        self.next_cmd_time += self.trapq_manual_move(
+            self.trapq, self.next_cmd_time, cp, dist, speed, accel)
         self.rail.generate_steps(self.next_cmd_time)
         self.trapq_finalize_moves(self.trapq, self.next_cmd_time + 99999.9)
-        toolhead = self.printer.lookup_object('toolhead')
-        toolhead.note_kinematic_activity(self.next_cmd_time)
+        self.toolhead.note_kinematic_activity(self.next_cmd_time)
         if sync:
             self.sync_print_time()
     def do_homing_move(self, movepos, speed, accel, triggered, check_trigger):
@@ -84,23 +88,27 @@ class ManualStepper:
                             triggered, check_trigger)
     cmd_MANUAL_STEPPER_help = "Command a manually configured stepper"
     def cmd_MANUAL_STEPPER(self, gcmd):
-        enable = gcmd.get_int('ENABLE', None)
-        if enable is not None:
-            self.do_enable(enable)
-        setpos = gcmd.get_float('SET_POSITION', None)
-        if setpos is not None:
-            self.do_set_position(setpos)
-        speed = gcmd.get_float('SPEED', self.velocity, above=0.)
-        accel = gcmd.get_float('ACCEL', self.accel, minval=0.)
-        homing_move = gcmd.get_int('STOP_ON_ENDSTOP', 0)
-        if homing_move:
-            movepos = gcmd.get_float('MOVE')
-            self.do_homing_move(movepos, speed, accel,
-                                homing_move > 0, abs(homing_move) == 1)
-        elif gcmd.get_float('MOVE', None) is not None:
+        params = gcmd.get_command_parameters()
+        if 'ENABLE' in params:
+            self.do_enable(gcmd.get_int('ENABLE'))
+        if 'SET_POSITION' in params:
+            self.do_set_position(gcmd.get_float('SET_POSITION'))
+        speed, accel = self.velocity, self.accel
+        if 'SPEED' in params:
+            speed = gcmd.get_float('SPEED', above=0.)
+        if 'ACCEL' in params:
+            accel = gcmd.get_float('ACCEL', minval=0.)
+        homing_move = 0
+        if 'STOP_ON_ENDSTOP' in params:
+            homing_move = gcmd.get_int('STOP_ON_ENDSTOP')
+        if homing_move or 'MOVE' in params:
             movepos = gcmd.get_float('MOVE')
-            sync = gcmd.get_int('SYNC', 1)
-            self.do_move(movepos, speed, accel, sync)
+            if homing_move:
+                self.do_homing_move(movepos, speed, accel,
+                                    homing_move > 0, abs(homing_move) == 1)
+            else:
+                sync = gcmd.get_int('SYNC', 1)
+                self.do_move(movepos, speed, accel, sync)
         elif gcmd.get_int('SYNC', 0):
             self.sync_print_time()
     # Toolhead wrappers to support homing
@@ -122,7 +130,7 @@ class ManualStepper:
     def get_steppers(self):
         return self.steppers
     def calc_position(self, stepper_positions):
-        return [stepper_positions[self.rail.get_name()], 0., 0.]
+        return [stepper_positions[self.rail_name], 0., 0.]
 
 def load_config_prefix(config):
     return ManualStepper(config)
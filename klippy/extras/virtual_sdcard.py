@@ -3,9 +3,13 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, io
+import os, stat, logging, io, collections
 
-VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+VALID_GCODE_EXTS = frozenset(['gcode', 'g', 'gco'])
+
+READ_SIZE = 64 * 1024
+MIN_MUTEX_WAIT = 0.010
+MAX_MUTEX_WAIT = 0.100
 
 class VirtualSD:
     def __init__(self, config):
@@ -51,9 +55,11 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
+            prev = data[:readcount].decode('utf-8', 'replace')
+            upcoming = data[readcount:].decode('utf-8', 'replace')
             logging.info("Virtual sdcard (%d): %s\nUpcoming (%d): %s",
-                         readpos, repr(data[:readcount]),
-                         self.file_position, repr(data[readcount:]))
+                         readpos, repr(prev), self.file_position,
+                         repr(upcoming))
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
@@ -61,28 +67,36 @@ class VirtualSD:
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
+            prefix_len = len(os.path.join(self.sdcard_dirname, ''))
             for root, dirs, files in os.walk(
                     self.sdcard_dirname, followlinks=True):
                 for name in files:
-                    ext = name[name.rfind('.')+1:]
+                    ext = name.rpartition('.')[2]
                     if ext not in VALID_GCODE_EXTS:
                         continue
                     full_path = os.path.join(root, name)
-                    r_path = full_path[len(self.sdcard_dirname) + 1:]
+                    r_path = full_path[prefix_len:]
                     size = os.path.getsize(full_path)
                     flist.append((r_path, size))
             return sorted(flist, key=lambda f: f[0].lower())
         else:
             dname = self.sdcard_dirname
             try:
-                filenames = os.listdir(self.sdcard_dirname)
-                return [(fname, os.path.getsize(os.path.join(dname, fname)))
-                        for fname in sorted(filenames, key=str.lower)
-                        if not fname.startswith('.')
-                        and os.path.isfile((os.path.join(dname, fname)))]
+                flist = []
+                for fname in sorted(os.listdir(dname), key=str.lower):
+                    if fname.startswith('.'):
+                        continue
+                    # A single stat() provides both the type and the size
+                    try:
+                        st = os.stat(os.path.join(dname, fname))
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        flist.append((fname, st.st_size))
             except:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error("Unable to get file list")
+            return flist
     def get_status(self, eventtime):
         return {
             'file_path': self.file_path(),
@@ -168,22 +182,41 @@ class VirtualSD:
         if filename.startswith('/'):
             filename = filename[1:]
         self._load_file(gcmd, filename)
+    def _is_listed_file(self, filename, check_subdirs):
+        # Check if get_file_list() would report 'filename' exactly as given
+        if check_subdirs:
+            if (os.path.isabs(filename)
+                or os.path.normpath(filename) != filename
+                or filename.split(os.sep)[0] == os.pardir):
+                return False
+            name = os.path.basename(filename)
+            if name.rpartition('.')[2] not in VALID_GCODE_EXTS:
+                return False
+        elif os.sep in filename or filename.startswith('.'):
+            return False
+        return os.path.isfile(os.path.join(self.sdcard_dirname, filename))
     def _load_file(self, gcmd, filename, check_subdirs=False):
-        files = self.get_file_list(check_subdirs)
-        flist = [f[0] for f in files]
-        files_by_lower = { fname.lower(): fname for fname, fsize in files }
         fname = filename
+        if not self._is_listed_file(fname, check_subdirs):
+            # Fall back to a case-insensitive match against the file list
+            files = self.get_file_list(check_subdirs)
+            files_by_lower = { fn.lower(): fn for fn, fsize in files }
+            fname = files_by_lower.get(fname.lower())
+            if fname is None:
+                raise gcmd.error("Unable to open file")
         try:
-            if fname not in flist:
-                fname = files_by_lower[fname.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+            f = io.open(fname, 'rb', buffering=0)
+            fsize = os.fstat(f.fileno()).st_size
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
+        if hasattr(os, 'posix_fadvise'):
+            # Print files are read front to back - enlarge readahead
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
         self.current_file = f
@@ -227,14 +260,15 @@ class VirtualSD:
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        partial_input = b""
+        lines = collections.deque()
         error_message = None
+        mutex_wait = MIN_MUTEX_WAIT
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = self.current_file.read(READ_SIZE)
                 except:
                     logging.exception("virtual_sdcard read")
                     break
@@ -245,23 +279,25 @@ class VirtualSD:
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
+                lines.extend(data.split(b'\n'))
                 lines[0] = partial_input + lines[0]
                 partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
-                self.reactor.pause(self.reactor.monotonic() + 0.100)
+                # Poll quickly at first as most requests finish promptly
+                self.reactor.pause(self.reactor.monotonic() + mutex_wait)
+                mutex_wait = min(mutex_wait * 2., MAX_MUTEX_WAIT)
                 continue
+            mutex_wait = MIN_MUTEX_WAIT
             # Dispatch command
             self.cmd_from_sd = True
-            line = lines.pop()
+            line = lines.popleft()
             next_file_position = self.file_position + len(line) + 1
             self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                self.gcode.run_script(line.decode('utf-8'))
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -282,8 +318,8 @@ class VirtualSD:
                     logging.exception("virtual_sdcard seek")
                     self.work_timer = None
                     return self.reactor.NEVER
-                lines = []
-                partial_input = ""
+                lines.clear()
+                partial_input = b""
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -1,4 +1,6 @@
 ; Large example, to test M808 looping with `partial_data`
+; Non-ASCII text (°C, é) must not disturb the byte offsets
+CHECK_SD_POSITION POSITION=119
 M808 L20
 ; Looping
 G92 E0